@@ -1,4 +1,6 @@
 import argparse
+import asyncio
+import functools
 import os
 import sys
 import time
@@ -6,14 +8,27 @@ import json
 import re
 import uuid
 import hashlib
+import struct
 import datetime as dt
 import unicodedata
+from concurrent.futures import ThreadPoolExecutor
 from typing import Any, Dict, List, Optional, Tuple, Iterable
 
-import requests
-from tenacity import retry, wait_exponential, stop_after_attempt
+import aiohttp
+import orjson
+from aiolimiter import AsyncLimiter
+from tenacity import AsyncRetrying, RetryCallState, wait_exponential, stop_after_attempt
 from google.cloud import firestore
 from google.cloud.firestore_v1 import DELETE_FIELD
+from google.cloud.firestore_v1.bulk_writer import BulkWriteFailure, BulkWriter
+
+try:
+    from itertools import batched as _batched  # Python 3.12+
+except ImportError:
+    def _batched(iterable: Iterable[Any], size: int) -> Iterable[List[Any]]:
+        items = list(iterable)
+        return (items[i : i + size] for i in range(0, len(items), size))
+
 
 US_STATES = [
     "AL","AK","AZ","AR","CA","CO","CT","DE","FL","GA",
@@ -22,10 +37,31 @@ US_STATES = [
     "NM","NY","NC","ND","OH","OK","OR","PA","RI","SC",
     "SD","TN","TX","UT","VT","VA","WA","WV","WI","WY",
 ]
+US_STATES_SET = frozenset(US_STATES)
 
 DEFAULT_OVERPASS_URL = os.environ.get("OVERPASS_API_URL", "https://overpass-api.de/api/interpreter")
 DEFAULT_PROJECT = os.environ.get("GOOGLE_CLOUD_PROJECT", "buoyant-ability-465005-d7")
 DEFAULT_DATABASE = os.environ.get("GOOGLE_CLOUD_FIRESTORE_DATABASE", "golf-course-db")
+# Overpass is rate-limited per client; keep parallel state fetches low
+OVERPASS_CONCURRENCY = 4
+# Token bucket guarding against bursts (e.g. all workers starting or retrying at once);
+# with calls taking 10s+ it rarely delays steady-state requests
+OVERPASS_RATE_PER_SEC = 2
+# Statuses where Overpass may send Retry-After; honored instead of the blind backoff
+OVERPASS_RETRY_AFTER_STATUSES = (429, 504)
+# Firestore RPCs release the GIL while waiting on gRPC, so threads overlap round-trips
+FIRESTORE_READ_WORKERS = 10
+FIRESTORE_STATE_WORKERS = 8
+# Attempts per doc before BulkWriter gives up on it (matches the SDK's default error handler)
+FIRESTORE_BULK_MAX_ATTEMPTS = 15
+
+_SLUG_STRIP = re.compile(r"[^a-z0-9\-\s]")
+_SLUG_DASH = re.compile(r"[\s_]+")
+_HOLES = re.compile(r"(9|18|27|36|45|54)")
+_ALIAS_SPLIT = re.compile(r"[;,]")
+
+# Shared by every course in a run; interned so all docs reference one string object
+_SOURCE = sys.intern(f"osm:{time.strftime('%Y-%m')}")
 
 
 def ensure_gcp_credentials() -> None:
@@ -43,8 +79,8 @@ def ensure_gcp_credentials() -> None:
 def slugify(*parts: str) -> str:
     text = "-".join([p for p in parts if p])
     text = text.lower()
-    text = re.sub(r"[^a-z0-9\-\s]", "", text)
-    text = re.sub(r"[\s_]+", "-", text).strip("-")
+    text = _SLUG_STRIP.sub("", text)
+    text = _SLUG_DASH.sub("-", text).strip("-")
     return text[:200]
 
 
@@ -94,7 +130,7 @@ def generate_name_tokens(name: str) -> List[str]:
 def parse_holes(tags: Dict[str, Any]) -> Optional[int]:
     holes = tags.get("golf:holes") or tags.get("holes")
     if isinstance(holes, str):
-        m = re.search(r"(9|18|27|36|45|54)", holes)
+        m = _HOLES.search(holes)
         if m:
             return int(m.group(1))
     if isinstance(holes, (int, float)):
@@ -129,7 +165,7 @@ def build_aliases(tags: Dict[str, Any]) -> List[str]:
     name_en = tags.get("name:en")
     for v in (alt_name, short_name, official_name, name_en):
         if isinstance(v, str):
-            aliases.extend([s.strip() for s in re.split(r"[;,]", v) if s.strip()])
+            aliases.extend([s.strip() for s in _ALIAS_SPLIT.split(v) if s.strip()])
     uniq: List[str] = []
     seen = set()
     for a in aliases:
@@ -141,22 +177,20 @@ def build_aliases(tags: Dict[str, Any]) -> List[str]:
 
 
 def compute_osm_fingerprint(doc: Dict[str, Any]) -> str:
-    payload = {
-        "name_lower": (doc.get("name_lower") or ""),
-        "aliases": sorted([(a or "").lower() for a in (doc.get("aliases") or [])]),
-        "city": (doc.get("city") or ""),
-        "state": (doc.get("state") or ""),
-        "lat": doc.get("lat"),
-        "lng": doc.get("lng"),
-        "holes": doc.get("holes"),
-        "website": (doc.get("website") or ""),
-        "country": (doc.get("country") or ""),
-    }
-    s = json.dumps(payload, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
-    return hashlib.sha256(s.encode("utf-8")).hexdigest()
+    # Feed fields to the hasher in a fixed order instead of building a JSON string
+    h = hashlib.sha256()
+    for key in ("name_lower", "city", "state", "country", "website"):
+        h.update((doc.get(key) or "").encode("utf-8"))
+        h.update(b"\x1f")
+    aliases = sorted([(a or "").lower() for a in (doc.get("aliases") or [])])
+    h.update("\x1e".join(aliases).encode("utf-8"))
+    h.update(b"\x1f")
+    h.update(struct.pack("<ddi", doc.get("lat") or 0.0, doc.get("lng") or 0.0, doc.get("holes") or 0))
+    return h.hexdigest()
 
 
 def normalize_course(element: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    # Keep these leisure/name guards in sync with the precheck in fetch_courses_by_state
     tags = element.get("tags") or {}
     if tags.get("leisure") != "golf_course":
         return None
@@ -180,6 +214,10 @@ def normalize_course(element: Dict[str, Any]) -> Optional[Dict[str, Any]]:
     city, state, country = extract_city_state_country(tags)
     if not country:
         country = "US"
+    if isinstance(country, str):
+        country = sys.intern(country)
+    if isinstance(state, str):
+        state = sys.intern(state)
     holes = parse_holes(tags)
 
     website = None
@@ -210,7 +248,7 @@ def normalize_course(element: Dict[str, Any]) -> Optional[Dict[str, Any]]:
         "lng": lon_f,
         "holes": holes,
         "website": website,
-        "source": f"osm:{time.strftime('%Y-%m')}",
+        "source": _SOURCE,
         "osm_id": osm_id,
         # fingerprint/osm_updated_at set later
     }
@@ -231,42 +269,56 @@ def overpass_query_for_state(state_code: str) -> str:
     """.strip()
 
 
-@retry(wait=wait_exponential(multiplier=1, min=1, max=60), stop=stop_after_attempt(5))
-def call_overpass(query: str, url: str = DEFAULT_OVERPASS_URL) -> Dict[str, Any]:
-    resp = requests.post(url, data={"data": query}, timeout=120)
-    resp.raise_for_status()
-    return resp.json()
+_overpass_backoff = wait_exponential(multiplier=1, min=1, max=60)
+
+
+def _wait_overpass(retry_state: RetryCallState) -> float:
+    exc = retry_state.outcome.exception() if retry_state.outcome else None
+    if isinstance(exc, aiohttp.ClientResponseError) and exc.status in OVERPASS_RETRY_AFTER_STATUSES:
+        retry_after = (exc.headers or {}).get("Retry-After", "")
+        if retry_after.isdigit():
+            return min(float(retry_after), 60.0)
+    return _overpass_backoff(retry_state)
+
 
+async def call_overpass(
+    session: aiohttp.ClientSession, limiter: AsyncLimiter, query: str, url: str = DEFAULT_OVERPASS_URL
+) -> Dict[str, Any]:
+    async for attempt in AsyncRetrying(wait=_wait_overpass, stop=stop_after_attempt(5), reraise=True):
+        with attempt:
+            await limiter.acquire()
+            async with session.post(
+                url, data={"data": query}, timeout=aiohttp.ClientTimeout(total=120)
+            ) as resp:
+                resp.raise_for_status()
+                return orjson.loads(await resp.read())
 
-def fetch_courses_by_state(state_code: str) -> List[Dict[str, Any]]:
+
+async def fetch_courses_by_state(
+    session: aiohttp.ClientSession, limiter: AsyncLimiter, state_code: str
+) -> List[Dict[str, Any]]:
     query = overpass_query_for_state(state_code)
-    data = call_overpass(query)
+    data = await call_overpass(session, limiter, query)
     elements = data.get("elements", [])
-    courses: List[Dict[str, Any]] = []
-    for el in elements:
-        doc = normalize_course(el)
-        if doc and doc.get("country") == "US":
-            if not doc.get("state"):
-                doc["state"] = state_code
-            courses.append(doc)
+    # Mirrors normalize_course's first guards; only saves a call per rejected element
+    courses: List[Dict[str, Any]] = [
+        doc
+        for el in elements
+        if (tags := el.get("tags")) and tags.get("leisure") == "golf_course" and isinstance(tags.get("name"), str)
+        for doc in (normalize_course(el),)
+        if doc and doc.get("country") == "US"
+    ]
+    for doc in courses:
+        if not doc.get("state"):
+            doc["state"] = sys.intern(state_code)
     return courses
 
 
+@functools.lru_cache(maxsize=4)
 def get_firestore_client(project: str, database: str) -> firestore.Client:
     return firestore.Client(project=project, database=database)
 
 
-def _batched(iterable: Iterable[Any], size: int) -> Iterable[List[Any]]:
-    batch: List[Any] = []
-    for item in iterable:
-        batch.append(item)
-        if len(batch) >= size:
-            yield batch
-            batch = []
-    if batch:
-        yield batch
-
-
 def upsert_courses(
     courses: List[Dict[str, Any]],
     project: str = DEFAULT_PROJECT,
@@ -278,44 +330,72 @@ def upsert_courses(
     if not courses:
         return (0, 0)
     client = get_firestore_client(project, database)
+    col = client.collection(collection)
 
-    # Prepare docs and compute ids + fingerprints
+    # Prepare docs and compute ids (+ fingerprints, only needed for skip decisions)
     prepared: Dict[str, Dict[str, Any]] = {}
     for course in courses:
         doc_id = slugify(course.get("name", ""), course.get("city", ""), course.get("state", ""))
-        course["osm_fingerprint"] = compute_osm_fingerprint(course)
+        if doc_id in prepared:
+            continue
+        if skip_unchanged:
+            course["osm_fingerprint"] = compute_osm_fingerprint(course)
         prepared[doc_id] = course
 
-    # Fetch existing docs to compare
-    existing: Dict[str, Dict[str, Any]] = {}
-    doc_refs = [client.collection(collection).document(doc_id) for doc_id in prepared.keys()]
-    for chunk in _batched(doc_refs, 300):
-        for snap in client.get_all(chunk):
-            if snap.exists:
-                existing[snap.id] = snap.to_dict()
-
-    batch = client.batch()
-    write_count = 0
+    # Fetch existing docs to compare (nothing reads them unless skipping unchanged)
+    existing: Dict[str, Optional[str]] = {}
+    if skip_unchanged:
+        doc_refs = [col.document(doc_id) for doc_id in prepared.keys()]
+        with ThreadPoolExecutor(max_workers=FIRESTORE_READ_WORKERS) as ex:
+            # Only the fingerprint is compared, so don't pull whole documents
+            results = ex.map(
+                lambda chunk: list(client.get_all(chunk, field_paths=["osm_fingerprint"])),
+                list(_batched(doc_refs, 300)),
+            )
+            # snap.get() raises KeyError for docs written without a fingerprint
+            existing = {
+                snap.id: (snap.to_dict() or {}).get("osm_fingerprint")
+                for snaps in results
+                for snap in snaps
+                if snap.exists
+            }
+
+    # BulkWriter pipelines writes and retries failed docs individually
+    bw = client.bulk_writer()
+    failed: List[str] = []
+
+    def _on_write_error(error: BulkWriteFailure, _bw: BulkWriter) -> bool:
+        if error.attempts < FIRESTORE_BULK_MAX_ATTEMPTS:
+            return True
+        print(f"Error writing {error.operation.reference.id}: {error.message}", file=sys.stderr)
+        failed.append(error.operation.reference.id)
+        return False
+
+    bw.on_write_error(_on_write_error)
+
+    submitted = 0
     skip_count = 0
     for doc_id, course in prepared.items():
-        prev = existing.get(doc_id)
-        if skip_unchanged and prev and prev.get("osm_fingerprint") == course.get("osm_fingerprint"):
-            skip_count += 1
-            continue
-        doc_ref = client.collection(collection).document(doc_id)
+        if skip_unchanged:
+            if existing.get(doc_id) == course["osm_fingerprint"]:
+                skip_count += 1
+                continue
+        doc_ref = col.document(doc_id)
         payload = {**course}
         payload["updated_at"] = firestore.SERVER_TIMESTAMP
         payload["osm_updated_at"] = firestore.SERVER_TIMESTAMP
         payload["last_seen_run_id"] = run_id
         payload["stale"] = False
         payload["stale_at"] = DELETE_FIELD
-        batch.set(doc_ref, payload, merge=True)
-        write_count += 1
-        if write_count % 400 == 0:
-            batch.commit()
-            batch = client.batch()
-    if write_count % 400 != 0:
-        batch.commit()
+        if not skip_unchanged:
+            # Don't leave an old fingerprint behind that no longer matches the written fields
+            payload["osm_fingerprint"] = DELETE_FIELD
+        bw.set(doc_ref, payload, merge=True)
+        submitted += 1
+    # flush() first: close() marks the writer closed before its own flush, so retries due then would raise
+    bw.flush()
+    bw.close()
+    write_count = submitted - len(failed)
     return (write_count, skip_count)
 
 
@@ -327,9 +407,11 @@ def mark_stale_for_states(
     run_id: str,
 ) -> int:
     client = get_firestore_client(project, database)
-    marked = 0
-    for st in states:
-        q = client.collection(collection).where("country", "==", "US").where("state", "==", st)
+    col = client.collection(collection)
+
+    def _process_state(st: str) -> int:
+        q = col.where("country", "==", "US").where("state", "==", st)
+        marked = 0
         batch = client.batch()
         for i, snap in enumerate(q.stream(), start=1):
             data = snap.to_dict() or {}
@@ -340,6 +422,11 @@ def mark_stale_for_states(
                 batch.commit()
                 batch = client.batch()
         batch.commit()
+        return marked
+
+    with ThreadPoolExecutor(max_workers=FIRESTORE_STATE_WORKERS) as ex:
+        futures = [ex.submit(_process_state, st) for st in states]
+        marked = sum(fut.result() for fut in futures)
     return marked
 
 
@@ -354,27 +441,30 @@ def purge_stale(
         return 0
     client = get_firestore_client(project, database)
     cutoff = dt.datetime.utcnow() - dt.timedelta(days=older_than_days)
-    deleted = 0
     target_states = states or US_STATES
-    for st in target_states:
+    col = client.collection(collection)
+
+    def _process_state(st: str) -> int:
         q = (
-            client.collection(collection)
+            col
             .where("stale", "==", True)
             .where("state", "==", st)
+            .where("stale_at", "<=", cutoff)
         )
+        deleted = 0
         batch = client.batch()
-        i = 0
         for snap in q.stream():
-            data = snap.to_dict() or {}
-            stale_at = data.get("stale_at")
-            if isinstance(stale_at, dt.datetime) and stale_at <= cutoff:
-                batch.delete(snap.reference)
-                deleted += 1
-                i += 1
-                if i % 400 == 0:
-                    batch.commit()
-                    batch = client.batch()
+            batch.delete(snap.reference)
+            deleted += 1
+            if deleted % 400 == 0:
+                batch.commit()
+                batch = client.batch()
         batch.commit()
+        return deleted
+
+    with ThreadPoolExecutor(max_workers=FIRESTORE_STATE_WORKERS) as ex:
+        futures = [ex.submit(_process_state, st) for st in target_states]
+        deleted = sum(fut.result() for fut in futures)
     return deleted
 
 
@@ -396,20 +486,45 @@ def run(
 
     run_id = run_id or f"run-{dt.datetime.now(dt.timezone.utc).strftime('%Y%m%d%H%M%S')}-{uuid.uuid4().hex[:8]}"
 
-    all_courses: List[Dict[str, Any]] = []
+    fetch_states: List[str] = []
     for st in target_states:
         st = st.upper()
-        if st not in US_STATES:
+        if st not in US_STATES_SET:
             print(f"Skip invalid state: {st}", file=sys.stderr)
             continue
-        print(f"Fetching state {st}...")
-        try:
-            courses = fetch_courses_by_state(st)
-        except Exception as e:
-            print(f"Error fetching {st}: {e}", file=sys.stderr)
-            continue
-        print(f"  Found {len(courses)} courses")
-        all_courses.extend(courses)
+        fetch_states.append(st)
+
+    async def _main() -> List[List[Dict[str, Any]]]:
+        sem = asyncio.Semaphore(OVERPASS_CONCURRENCY)
+        # Built per event loop: run() calls asyncio.run() each time
+        limiter = AsyncLimiter(OVERPASS_RATE_PER_SEC, 1)
+        # One keep-alive pool for every state: TCP/TLS setup is paid once per connection, not per request
+        connector = aiohttp.TCPConnector(limit=OVERPASS_CONCURRENCY, keepalive_timeout=60)
+        async with aiohttp.ClientSession(connector=connector) as session:
+
+            async def _fetch(st: str) -> List[Dict[str, Any]]:
+                async with sem:
+                    print(f"Fetching state {st}...")
+                    try:
+                        courses = await fetch_courses_by_state(session, limiter, st)
+                    except Exception as e:
+                        print(f"Error fetching {st}: {e}", file=sys.stderr)
+                        return []
+                    print(f"  Found {len(courses)} courses in {st}")
+                    return courses
+
+            return await asyncio.gather(*[_fetch(st) for st in fetch_states])
+
+    # The same OSM element can come back from neighbouring state queries
+    all_courses: List[Dict[str, Any]] = []
+    seen = set()
+    for courses in asyncio.run(_main()):
+        for doc in courses:
+            key = doc.get("osm_id") or slugify(doc.get("name", ""), doc.get("city", ""), doc.get("state", ""))
+            if key in seen:
+                continue
+            seen.add(key)
+            all_courses.append(doc)
 
     if dry_run:
         print(json.dumps(all_courses[:10], ensure_ascii=False, indent=2))